@@ -1,35 +1,115 @@
 import os
+
+# Um único thread por instância do Tesseract: o paralelismo fica por conta do
+# pool de processos de OCR (o OpenMP interno do Tesseract escala mal)
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+import csv
+import functools
+import hashlib
+import io
 import json
+import asyncio
 import logging
+import mimetypes
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Set, Tuple
+from typing import Awaitable, Dict, List, Optional, Set, Tuple
 
+from diskcache import Cache
 from dotenv import load_dotenv
+from openpyxl import Workbook
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
 from PIL import Image
-import pytesseract
+import cv2
+import numpy as np
+
+try:
+    from tesserocr import OEM, PyTessBaseAPI
+
+    USA_TESSEROCR = True
+except ImportError:
+    # Sem tesserocr: usa o binário do Tesseract em lote via pytesseract
+    import pytesseract
+
+    USA_TESSEROCR = False
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
 from google import genai
+from google.genai import errors, types
+from pydantic import BaseModel, TypeAdapter
 
 # ── Setup ────────────────────────────────────────────────────────────────
+# Só lê o .env: os workers de OCR (que importam este módulo ao iniciar) também
+# precisam de TESSDATA_PATH/TESSERACT_CMD. O resto do setup fica em inicializar().
 load_dotenv()
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[logging.FileHandler("processamento.log"), logging.StreamHandler()],
-)
-
-pytesseract.pytesseract.tesseract_cmd = os.getenv("TESSERACT_CMD")
-
-client = genai.Client(api_key=os.getenv("GENAI_API_KEY"))
+TESSDATA_PATH = os.getenv("TESSDATA_PATH")
+TESSERACT_CMD = os.getenv("TESSERACT_CMD")
+# Resolução para a qual as imagens são reamostradas antes do OCR. DPI abaixo
+# de OCR_DPI_MINIMO (72/96 de PNGs de captura de tela) é metadado de fábrica,
+# não resolução de scanner: nesses casos a imagem não é reamostrada.
+OCR_DPI = 300
+OCR_DPI_MINIMO = 150
+OCR_ESCALA_MAXIMA = 2.0
+# Sem tesserocr: mínimo de imagens por execução do Tesseract, para diluir o
+# custo de subir o processo
+OCR_IMAGENS_POR_EXECUCAO = int(os.getenv("OCR_IMAGENS_POR_EXECUCAO", "8"))
 
 BASE_PATH = Path(os.getenv("BASE_PATH"))
-EXTENSOES = tuple(map(str.lower, os.getenv("EXTENSOES").split(",")))
+# Extensões aceitas, sem o ponto (".png,.jpg" e "png,jpg" são equivalentes)
+EXTENSOES = frozenset(
+    e.strip().lower().lstrip(".") for e in os.getenv("EXTENSOES").split(",")
+)
 ARQUIVO_SAIDA = Path("questoes_classificadas.xlsx")
+# Saída incremental (append-only); convertida para ARQUIVO_SAIDA ao final
+ARQUIVO_SAIDA_CSV = Path("questoes_classificadas.csv")
+COLUNAS_SAIDA = [
+    "arquivo",
+    "caminho_completo",
+    "numero_questao",
+    "texto_questao",
+    "tema",
+    "topico",
+    "ano",
+    "semestre",
+    "materia",
+    "gabarito",
+]
 
 ARQUIVO_BD_QUESTOES = Path("bd_questoes.xlsx")
 ARQUIVO_LISTA_ASSUNTOS = Path("lista_assuntos.xlsx")
 
+# Limite de chamadas simultâneas ao Gemini (número de consumidores da fila)
+MAX_CONCORRENCIA = int(os.getenv("MAX_CONCORRENCIA", "10"))
+# Textos já extraídos aguardando classificação
+TAMANHO_FILA = 32
+# Arquivos entre o envio ao OCR e a retirada da fila por um consumidor, somando
+# todos os anos/semestres. Sem tesserocr cabe uma execução cheia por worker.
+LIMITE_OCR = (
+    TAMANHO_FILA
+    if USA_TESSEROCR
+    else max(TAMANHO_FILA, (os.cpu_count() or 1) * OCR_IMAGENS_POR_EXECUCAO)
+)
+
+# Envia as imagens direto ao Gemini (sem Tesseract), várias por chamada
+CLASSIFICAR_IMAGENS = os.getenv("CLASSIFICAR_IMAGENS", "0") == "1"
+TAMANHO_LOTE_IMAGENS = int(os.getenv("TAMANHO_LOTE_IMAGENS", "6"))
+
+MODELO = "gemini-2.5-flash"
+
+# Validade do cache de contexto (lista de assuntos) no Gemini
+CACHE_TTL_SEGUNDOS = int(os.getenv("CACHE_TTL_SEGUNDOS", "3600"))
+CACHE_RENOVACAO_SEGUNDOS = 300
+
+# Respostas do Gemini em disco, por (matéria, versão do prompt, texto da questão):
+# reexecuções com o mesmo OCR não chamam a API de novo
+CACHE_RESPOSTAS_DIR = os.getenv("CACHE_RESPOSTAS_DIR", ".gemini_cache")
+
 # Anos e semestres fixos
 ANOS_SEMESTRES = [
     {"ano": 2015, "semestre": 1},
@@ -51,22 +131,24 @@ ANOS_SEMESTRES = [
     {"ano": 2025, "semestre": 2},
 ]
 
-logging.info("Iniciando script de classificação de questões")
 
 # ── Carregamentos ──────────────────────────────────────────────────────────────
-try:
-    tabela_assuntos = pd.read_excel(ARQUIVO_LISTA_ASSUNTOS)
-    logging.info(f"Lista de assuntos carregada ({len(tabela_assuntos)} tópicos)")
-except Exception as e:
-    logging.error(f"Erro ao carregar {ARQUIVO_LISTA_ASSUNTOS}: {e}")
-    raise
-
-try:
-    bd_questoes = pd.read_excel(ARQUIVO_BD_QUESTOES)
-    logging.info(f"BD de questões carregado ({len(bd_questoes)} registros)")
-except Exception as e:
-    logging.error(f"Erro ao carregar {ARQUIVO_BD_QUESTOES}: {e}")
-    raise
+def carregar_tabela(arquivo_excel: Path) -> pd.DataFrame:
+    """
+    Lê a versão Parquet da planilha (gerada por scripts/convert.py), bem mais
+    rápida que o Excel. Se ela não existir ou estiver desatualizada, lê o Excel.
+    """
+    arquivo_parquet = arquivo_excel.with_suffix(".parquet")
+    if arquivo_parquet.exists() and (
+        not arquivo_excel.exists()
+        or arquivo_parquet.stat().st_mtime >= arquivo_excel.stat().st_mtime
+    ):
+        return pd.read_parquet(arquivo_parquet)
+    logging.warning(
+        f"{arquivo_parquet} ausente ou desatualizado, lendo {arquivo_excel} "
+        "(rode scripts/convert.py)"
+    )
+    return pd.read_excel(arquivo_excel)
 
 
 # ── Seleções via JSON ─────────────────────────────────────────────────────────
@@ -95,44 +177,54 @@ def carregar_selecoes() -> Dict[Tuple[int, int], Set[str]]:
         return {}
 
 
-SELECOES = carregar_selecoes()
+# ── Funções principais ────────────────────────────────────────────────────────
+class Classificacao(BaseModel):
+    tema: str
+    topico: str
 
 
-# ── Funções principais ────────────────────────────────────────────────────────
-def processar_resposta_gemini(
-    resposta: str, numero_questao: str
+class ClassificacaoComNumero(Classificacao):
+    numero_questao: str
+
+
+# Resposta estruturada do Gemini: lista de {tema, topico} (uma questão) ou de
+# {numero_questao, tema, topico} (lote de imagens)
+RESPOSTA_ADAPTER = TypeAdapter(List[Classificacao])
+RESPOSTA_LOTE_ADAPTER = TypeAdapter(List[ClassificacaoComNumero])
+
+
+def normalizar_numero(stem: str) -> str:
+    return str(int(stem)) if stem.isdigit() else stem.strip()
+
+
+def converter_classificacoes(
+    classificacoes: List[Classificacao], numero_questao: str
 ) -> List[Dict[str, str]]:
-    linhas_classificadas = []
-    for linha in resposta.strip().split("\n"):
-        linha = linha.strip()
-        if not linha or "|" not in linha or linha.startswith(("| tema", "|---")):
-            continue
-        partes = [p.strip() for p in linha.split("|")]
+    return [
+        {"numero_questao": numero_questao, **c.model_dump()}
+        for c in classificacoes
+        if c.tema and c.topico
+    ]
 
-        if len(partes) != 5:
-            logging.warning(f"Partes: {partes}")
-            raise ValueError(
-                f"Resposta inesperada para Q{numero_questao}: '{linha}' (esperado 5 colunas, obteve {len(partes)})"
-            )
 
-        tema = partes[2]
-        topico = partes[3]
-        if tema and topico:
-            linhas_classificadas.append(
-                {"numero_questao": numero_questao, "tema": tema, "topico": topico}
-            )
-    return linhas_classificadas
+# (numero_questao, ano, semestre) -> (materia, gabarito); mantém a primeira
+# ocorrência em caso de chave duplicada
+def indexar_bd(df: pd.DataFrame) -> Dict[Tuple[int, int, int], Tuple[str, str]]:
+    bd: Dict[Tuple[int, int, int], Tuple[str, str]] = {}
+    chaves = ["numero_questao", "ano", "semestre"]
+    for r in df.dropna(subset=chaves).itertuples(index=False):
+        bd.setdefault(
+            (int(r.numero_questao), int(r.ano), int(r.semestre)),
+            (r.materia, r.gabarito),
+        )
+    return bd
 
 
 def obter_info_questao(numero_questao: str, ano: int, semestre: int):
     try:
-        m = bd_questoes[
-            (bd_questoes["numero_questao"] == int(numero_questao))
-            & (bd_questoes["ano"] == int(ano))
-            & (bd_questoes["semestre"] == int(semestre))
-        ]
-        if not m.empty:
-            return m.iloc[0]["materia"], m.iloc[0]["gabarito"]
+        info = BD.get((int(numero_questao), int(ano), int(semestre)))
+        if info is not None:
+            return info
         logging.warning(
             f"Questão {numero_questao} ({ano}/{semestre}) não encontrada no BD"
         )
@@ -142,61 +234,237 @@ def obter_info_questao(numero_questao: str, ano: int, semestre: int):
         return "N/A", "N/A"
 
 
-def classificar_questao(
+INSTRUCOES_CLASSIFICACAO = """
+Você deve se comportar como um professor de ensino médio que tem que classificar os assuntos que cada uma das questões enviadas aborda. 
+Você deve analisar o conteúdo da questão e avaliar quais assuntos da lista de assuntos estão presentes na questão. 
+Vou te enviar o texto da questão e você deve responder apenas com os temas e tópicos da lista de assuntos que a questão aborda.
+Sua resposta deve ser uma lista em JSON com um objeto por tópico, com os campos "tema" e "topico".
+
+Uma questão pode abordar mais de um tópico, nesse caso cada tópico deve ser um item da lista. Você não deve inventar novos tópicos deve usar apenas os tópicos presentes na lista. 
+Você deve usar apenas as colunas tema e topico da lista de assuntos.
+""".strip()
+
+
+def _tabela_para_csv(tabela: pa.Table) -> str:
+    # Cabeçalho montado à mão: o write_csv põe aspas nele mesmo com "none"
+    cabecalho = "|".join(tabela.column_names) + "\n"
+    buffer = io.BytesIO()
+    try:
+        pa_csv.write_csv(
+            tabela,
+            buffer,
+            write_options=pa_csv.WriteOptions(
+                include_header=False, delimiter="|", quoting_style="none"
+            ),
+        )
+    except pa.ArrowInvalid:
+        # Algum valor contém "|", aspas ou quebra de linha. Com "needed" o
+        # Arrow põe aspas em todo valor de texto, não só nesses.
+        buffer = io.BytesIO()
+        pa_csv.write_csv(
+            tabela,
+            buffer,
+            write_options=pa_csv.WriteOptions(
+                include_header=False, delimiter="|", quoting_style="needed"
+            ),
+        )
+    return cabecalho + buffer.getvalue().decode("utf-8")
+
+
+def montar_assuntos_csv(tabela_assuntos: pd.DataFrame) -> Dict[str, str]:
+    """
+    Serializa a lista de assuntos uma única vez por matéria, só com os
+    tópicos da matéria. "N/A" (matéria desconhecida) leva a lista inteira.
+    """
+    # Tabela Arrow: filtros e CSV rodam nos kernels em C++. Colunas de texto
+    # viram "string" antes: o read_excel deixa números (ex.: um tema "1")
+    # como int no meio dos textos, o que o Arrow recusa; nulos continuam nulos.
+    texto = tabela_assuntos.select_dtypes("object").columns
+    assuntos = pa.Table.from_pandas(
+        tabela_assuntos.astype({c: "string" for c in texto}), preserve_index=False
+    )
+    resultado = {"N/A": _tabela_para_csv(assuntos)}
+    materias = pc.unique(assuntos["materia"].drop_null())
+    for materia in materias.to_pylist():
+        resultado[materia] = _tabela_para_csv(
+            assuntos.filter(pc.equal(assuntos["materia"], materia))
+        )
+    return resultado
+
+
+def chave_assuntos(materia_questao: str) -> str:
+    """Matérias sem tópicos próprios na lista usam a lista inteira ("N/A")."""
+    return materia_questao if materia_questao in ASSUNTOS_CSV else "N/A"
+
+
+def obter_assuntos_csv(materia_questao: str) -> str:
+    return ASSUNTOS_CSV[chave_assuntos(materia_questao)]
+
+
+def versao_prompt(instrucoes: str, materia_questao: str) -> str:
+    """Identifica instruções + lista de assuntos usados na chave do cache local."""
+    return hashlib.sha256(
+        f"{instrucoes}|{obter_assuntos_csv(materia_questao)}".encode()
+    ).hexdigest()
+
+
+# ── Cache de contexto do Gemini ───────────────────────────────────────────────
+# Instruções + lista de assuntos são idênticas para todas as questões de uma
+# mesma matéria: ficam num cachedContent e cada chamada envia só a questão.
+CACHES: Dict[str, str] = {}
+CACHES_EXPIRACAO: Dict[str, float] = {}
+CACHES_INDISPONIVEIS: Set[str] = set()
+# Depois de um erro temporário (429, 503...), espera antes de tentar de novo
+CACHES_NOVA_TENTATIVA: Dict[str, float] = {}
+CACHE_ESPERA_ERRO_SEGUNDOS = 60
+# Um lock por matéria: a criação/renovação de uma não segura as outras
+_locks_caches: Dict[str, asyncio.Lock] = {}
+
+
+async def obter_cache(materia_questao: str) -> Optional[str]:
+    """
+    Retorna o nome do cachedContent da matéria, criando-o na primeira vez e
+    renovando o TTL quando estiver perto de expirar. Retorna None se o cache
+    não puder ser criado (a chamada segue com o prompt completo).
+    """
+    lock = _locks_caches.setdefault(materia_questao, asyncio.Lock())
+    nome = CACHES.get(materia_questao)
+    restante = CACHES_EXPIRACAO.get(materia_questao, 0) - time.monotonic()
+    # Cache ainda válido e já sendo renovado por outra questão: não espera
+    if nome is not None and restante > 0 and lock.locked():
+        return nome
+
+    async with lock:
+        if materia_questao in CACHES_INDISPONIVEIS:
+            return None
+        nome = CACHES.get(materia_questao)
+        agora = time.monotonic()
+        restante = CACHES_EXPIRACAO.get(materia_questao, 0) - agora
+        if nome is not None and restante >= CACHE_RENOVACAO_SEGUNDOS:
+            return nome
+        if agora < CACHES_NOVA_TENTATIVA.get(materia_questao, 0):
+            return nome
+        try:
+            if nome is None:
+                cache = await client.aio.caches.create(
+                    model=MODELO,
+                    config=types.CreateCachedContentConfig(
+                        display_name=f"assuntos-{materia_questao}",
+                        system_instruction=INSTRUCOES_CLASSIFICACAO,
+                        contents=[
+                            "A lista de assuntos é:\n"
+                            + obter_assuntos_csv(materia_questao)
+                        ],
+                        ttl=f"{CACHE_TTL_SEGUNDOS}s",
+                    ),
+                )
+                nome = cache.name
+                CACHES[materia_questao] = nome
+                logging.info(f"Cache de assuntos criado para {materia_questao}: {nome}")
+            else:
+                await client.aio.caches.update(
+                    name=nome,
+                    config=types.UpdateCachedContentConfig(
+                        ttl=f"{CACHE_TTL_SEGUNDOS}s"
+                    ),
+                )
+                logging.info(f"TTL do cache de {materia_questao} renovado")
+        except Exception as e:
+            # INVALID_ARGUMENT (ex.: lista pequena demais para cache) não muda
+            # durante a execução; os demais erros são tentados de novo depois
+            if (
+                nome is None
+                and isinstance(e, errors.APIError)
+                and e.status == "INVALID_ARGUMENT"
+            ):
+                logging.warning(
+                    f"Cache de contexto indisponível para {materia_questao}: {e}"
+                )
+                CACHES_INDISPONIVEIS.add(materia_questao)
+            else:
+                logging.warning(
+                    f"Erro no cache de contexto de {materia_questao}, nova "
+                    f"tentativa em {CACHE_ESPERA_ERRO_SEGUNDOS}s: {e}"
+                )
+                CACHES_NOVA_TENTATIVA[materia_questao] = (
+                    time.monotonic() + CACHE_ESPERA_ERRO_SEGUNDOS
+                )
+            return nome
+
+        CACHES_EXPIRACAO[materia_questao] = time.monotonic() + CACHE_TTL_SEGUNDOS
+        return nome
+
+
+async def remover_caches():
+    for materia, nome in CACHES.items():
+        try:
+            await client.aio.caches.delete(name=nome)
+        except Exception as e:
+            logging.warning(f"Erro ao remover cache de {materia} ({nome}): {e}")
+    CACHES.clear()
+    CACHES_EXPIRACAO.clear()
+
+
+async def classificar_questao(
     numero_questao: str, texto_questao: str, ano: int, semestre: int
 ):
     try:
         materia_questao, gabarito_questao = obter_info_questao(
             numero_questao, ano, semestre
         )
-        if materia_questao == "N/A":
-            topicos_prioritarios = tabela_assuntos
-        else:
-            topicos_prioritarios = tabela_assuntos[
-                tabela_assuntos["materia"] == materia_questao
-            ]
+        chave_resposta = hashlib.sha256(
+            f"{materia_questao}|"
+            f"{versao_prompt(INSTRUCOES_CLASSIFICACAO, materia_questao)}|"
+            f"json|{texto_questao}".encode()
+        ).hexdigest()
+        resposta_salva = CACHE_RESPOSTAS.get(chave_resposta)
+        if resposta_salva is not None:
+            logging.info(
+                f"Q{numero_questao} ({ano}/{semestre}) encontrada no cache local"
+            )
+            classificacoes = converter_classificacoes(
+                RESPOSTA_ADAPTER.validate_json(resposta_salva), numero_questao
+            )
+            return classificacoes, materia_questao, gabarito_questao
 
-        assuntos_str = pd.concat(
-            [
-                topicos_prioritarios,
-                tabela_assuntos[
-                    ~tabela_assuntos.index.isin(topicos_prioritarios.index)
-                ],
-            ]
-        ).to_csv(index=False, sep="|")
-
-        prompt = f"""
-Você deve se comportar como um professor de ensino médio que tem que classificar os assuntos que cada uma das questões enviadas aborda. 
-Você deve analisar o conteúdo da questão e avaliar quais assuntos da lista de assuntos estão presentes na questão. 
-Vou te enviar o texto da questão e você deve responder apenas com os temas e tópicos da lista de assuntos que a questão aborda.
-Sua resposta deve estar no formato de tabela com as colunas: 
-| tema | topico 
-
-Sua resposta não deve conter nenhuma outra informação além da tabela.
-Sua resposta não deve conter `````, nem qualquer outra coisa que não seja a tabela.
-Exemplo de resposta correta:
-| tema | topico |
-|---|---|
-| Grandezas físicas | Medição de tempo |
-| Eletrodinâmica | Corrente elétrica |
-| Eletrostática | Carga elétrica |
-
-Uma questão pode abordar mais de um tópico, nesse caso cada tópico deve ser uma linha. Você não deve inventar novos tópicos deve usar apenas os tópicos presentes na lista. 
-Você deve usar apenas as colunas tema e topico da lista de assuntos.
+        chave = chave_assuntos(materia_questao)
+        cache = await obter_cache(chave)
+
+        if cache:
+            prompt = f"Questão:\n{texto_questao}"
+        else:
+            assuntos_str = obter_assuntos_csv(chave)
+            prompt = f"""
+{INSTRUCOES_CLASSIFICACAO}
 A lista de assuntos é:
 {assuntos_str}
 
 Questão:
 {texto_questao}
 """.strip()
+
         logging.info(
             f"Enviando Q{numero_questao} ({ano}/{semestre}) para classificação"
         )
-        response = client.models.generate_content(
-            model="gemini-2.5-flash", contents=prompt
+        response = await client.aio.models.generate_content(
+            model=MODELO,
+            contents=prompt,
+            config=types.GenerateContentConfig(
+                cached_content=cache,
+                response_mime_type="application/json",
+                response_schema=list[Classificacao],
+            ),
+        )
+        logging.debug(
+            f"Resposta de Q{numero_questao} ({ano}/{semestre}): {response.text}"
         )
-        print(response.text)
-        classificacoes = processar_resposta_gemini(response.text, numero_questao)
+        if response.parsed is None:
+            raise ValueError(
+                f"Resposta inesperada para Q{numero_questao}: '{response.text}'"
+            )
+        classificacoes = converter_classificacoes(response.parsed, numero_questao)
+        # Só guarda respostas que foram interpretadas sem erro
+        CACHE_RESPOSTAS[chave_resposta] = response.text
         return classificacoes, materia_questao, gabarito_questao
     except Exception as e:
         logging.error(f"Erro ao classificar questão {numero_questao}: {e}")
@@ -213,6 +481,82 @@ Questão:
         )
 
 
+INSTRUCOES_LOTE_IMAGENS = """
+As questões a seguir foram enviadas como imagens, cada uma precedida pelo seu número.
+Classifique cada questão separadamente e inclua em cada item o campo "numero_questao" com o número da questão correspondente.
+""".strip()
+
+
+async def classificar_lote_imagens(
+    numeros: List[str], caminhos: List[Path], chave: str, ano: int, semestre: int
+) -> Dict[str, List[Dict[str, str]]]:
+    """
+    Classifica várias questões numa única chamada multimodal, a partir das
+    imagens. Todas as questões do lote devem compartilhar a mesma lista de
+    assuntos (chave). Retorna as classificações por número normalizado.
+    """
+    imagens = [await asyncio.to_thread(c.read_bytes) for c in caminhos]
+
+    chave_resposta = hashlib.sha256(
+        f"{chave}|"
+        f"{versao_prompt(INSTRUCOES_CLASSIFICACAO + INSTRUCOES_LOTE_IMAGENS, chave)}|"
+        "imagens|".encode()
+        + b"|".join(
+            n.encode() + b":" + hashlib.sha256(img).digest()
+            for n, img in zip(numeros, imagens)
+        )
+    ).hexdigest()
+    resposta = CACHE_RESPOSTAS.get(chave_resposta)
+
+    if resposta is not None:
+        logging.info(f"Lote {numeros} ({ano}/{semestre}) encontrado no cache local")
+        itens = RESPOSTA_LOTE_ADAPTER.validate_json(resposta)
+    else:
+        cache = await obter_cache(chave)
+        if cache:
+            prompt = INSTRUCOES_LOTE_IMAGENS
+        else:
+            prompt = f"""
+{INSTRUCOES_CLASSIFICACAO}
+A lista de assuntos é:
+{obter_assuntos_csv(chave)}
+
+{INSTRUCOES_LOTE_IMAGENS}
+""".strip()
+
+        contents: List = [prompt]
+        for numero, caminho, imagem in zip(numeros, caminhos, imagens):
+            mime_type = mimetypes.guess_type(caminho.name)[0] or "image/png"
+            contents.append(f"Questão {numero}:")
+            contents.append(types.Part.from_bytes(data=imagem, mime_type=mime_type))
+
+        logging.info(f"Enviando lote {numeros} ({ano}/{semestre}) para classificação")
+        response = await client.aio.models.generate_content(
+            model=MODELO,
+            contents=contents,
+            config=types.GenerateContentConfig(
+                cached_content=cache,
+                response_mime_type="application/json",
+                response_schema=list[ClassificacaoComNumero],
+            ),
+        )
+        logging.debug(f"Resposta do lote {numeros}: {response.text}")
+        if response.parsed is None:
+            raise ValueError(
+                f"Resposta inesperada para o lote {numeros}: '{response.text}'"
+            )
+        itens = response.parsed
+        CACHE_RESPOSTAS[chave_resposta] = response.text
+
+    por_numero: Dict[str, List[Dict[str, str]]] = {}
+    for item in itens:
+        numero = normalizar_numero(item.numero_questao)
+        por_numero.setdefault(numero, []).extend(
+            converter_classificacoes([item], numero)
+        )
+    return por_numero
+
+
 def construir_caminho_pasta(ano: int, semestre: int) -> Path:
     return BASE_PATH / str(ano) / f"{semestre}º Semestre" / "02-Fotos Questões" / "PNG"
 
@@ -225,11 +569,12 @@ def listar_arquivos_para_processar(
         return []
 
     # Lista todos os arquivos válidos
-    todos = [
-        f
-        for f in os.listdir(pasta)
-        if f.lower().endswith(EXTENSOES) and (pasta / f).is_file()
-    ]
+    with os.scandir(pasta) as entradas:
+        todos = [
+            e.name
+            for e in entradas
+            if e.is_file() and Path(e.name).suffix.lower().lstrip(".") in EXTENSOES
+        ]
 
     # Há seleções globais em selecoes.json?
     ha_selecoes_globais = any(len(s) > 0 for s in selecoes.values())
@@ -253,13 +598,10 @@ def listar_arquivos_para_processar(
 
     # Modo seleção ativo E existem chaves para este (ano, semestre):
     # processar apenas as questões listadas
-    def normaliza_nome(stem: str) -> str:
-        return str(int(stem)) if stem.isdigit() else stem.strip()
-
     filtrados: List[str] = []
     for f in todos:
         nome = Path(f).stem
-        if normaliza_nome(nome) in chaves:
+        if normalizar_numero(nome) in chaves:
             filtrados.append(f)
 
     if not filtrados:
@@ -274,62 +616,499 @@ def listar_arquivos_para_processar(
     return filtrados
 
 
-def processar_ano_semestre(ano: int, semestre: int):
+# Cada processo do pool de OCR mantém a sua PyTessBaseAPI, carregando o modelo
+# de português uma única vez
+_tess_api: Optional["PyTessBaseAPI"] = None
+
+
+def inicializar_worker_ocr():
+    global _tess_api
+    if not USA_TESSEROCR:
+        if TESSERACT_CMD:
+            pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
+        return
+    kwargs = {"lang": "por", "oem": OEM.LSTM_ONLY}
+    if TESSDATA_PATH:
+        kwargs["path"] = TESSDATA_PATH
+    _tess_api = PyTessBaseAPI(**kwargs)
+
+
+def preprocessar_imagem(imagem: Image.Image) -> Image.Image:
+    """Tons de cinza + reamostragem para 300 DPI + limiarização adaptativa."""
+    cinza = cv2.cvtColor(np.array(imagem.convert("RGB")), cv2.COLOR_RGB2GRAY)
+    # Reamostra antes de binarizar: interpolar uma imagem já binária gera
+    # bordas serrilhadas e cinzas que o limiar não trata
+    dpi_atual = float(imagem.info.get("dpi", (0, 0))[0])
+    if dpi_atual >= OCR_DPI_MINIMO:
+        escala = min(OCR_DPI / dpi_atual, OCR_ESCALA_MAXIMA)
+        if abs(escala - 1) > 0.01:
+            cinza = cv2.resize(
+                cinza,
+                None,
+                fx=escala,
+                fy=escala,
+                interpolation=cv2.INTER_CUBIC if escala > 1 else cv2.INTER_AREA,
+            )
+    binaria = cv2.adaptiveThreshold(
+        cinza, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 10
+    )
+    return Image.fromarray(binaria)
+
+
+def extrair_texto(caminho: Path) -> str:
+    api = _tess_api
+    with Image.open(caminho) as imagem:
+        api.SetImage(preprocessar_imagem(imagem))
+        return api.GetUTF8Text()
+
+
+def extrair_textos_lote(caminhos: List[Path]) -> List[str]:
+    """
+    OCR de várias imagens numa única execução do Tesseract (usado quando o
+    tesserocr não está disponível). As imagens pré-processadas são listadas
+    num .txt e a saída, separada por form feed, volta na mesma ordem.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        linhas = []
+        for i, caminho in enumerate(caminhos):
+            destino = Path(tmp) / f"{i:05d}.png"
+            with Image.open(caminho) as imagem:
+                preprocessar_imagem(imagem).save(destino, dpi=(OCR_DPI, OCR_DPI))
+            linhas.append(str(destino))
+
+        lista = Path(tmp) / "lote.txt"
+        lista.write_text("\n".join(linhas) + "\n", encoding="utf-8")
+        saida = pytesseract.image_to_string(str(lista), lang="por")
+
+    textos = saida.split("\f")[: len(caminhos)]
+    if len(textos) != len(caminhos):
+        raise ValueError(
+            f"OCR em lote retornou {len(textos)} página(s) para {len(caminhos)} imagem(ns)"
+        )
+    return textos
+
+
+def agendar_ocr(
+    caminhos: List[Path], ocr_pool: ProcessPoolExecutor
+) -> List[Awaitable[str]]:
+    """Dispara o OCR das imagens no pool e devolve um awaitable por imagem."""
+    loop = asyncio.get_running_loop()
+    if USA_TESSEROCR:
+        return [
+            loop.run_in_executor(ocr_pool, extrair_texto, caminho)
+            for caminho in caminhos
+        ]
+
+    # Poucas execuções do Tesseract, em paralelo, cada uma com pelo menos
+    # OCR_IMAGENS_POR_EXECUCAO imagens (exceto quando há menos que isso)
+    n_lotes = max(
+        1, min(os.cpu_count() or 1, len(caminhos) // OCR_IMAGENS_POR_EXECUCAO)
+    )
+    lotes = [caminhos[i::n_lotes] for i in range(n_lotes)]
+    futuros = [
+        loop.run_in_executor(ocr_pool, extrair_textos_lote, lote) for lote in lotes
+    ]
+
+    async def texto_do_lote(futuro: Awaitable[List[str]], posicao: int) -> str:
+        return (await futuro)[posicao]
+
+    return [
+        texto_do_lote(futuros[i % n_lotes], i // n_lotes) for i in range(len(caminhos))
+    ]
+
+
+def montar_linhas(
+    arquivo: str,
+    caminho: Path,
+    texto: str,
+    classificacoes: List[Dict[str, str]],
+    ano: int,
+    semestre: int,
+    materia: str,
+    gabarito: str,
+) -> List[Dict]:
+    return [
+        {
+            "arquivo": arquivo,
+            "caminho_completo": str(caminho),
+            "numero_questao": c["numero_questao"],
+            "texto_questao": texto,
+            "tema": c["tema"],
+            "topico": c["topico"],
+            "ano": ano,
+            "semestre": semestre,
+            "materia": materia,
+            "gabarito": gabarito,
+        }
+        for c in classificacoes
+    ]
+
+
+async def processar_arquivo(
+    arquivo: str,
+    pasta: Path,
+    ano: int,
+    semestre: int,
+    texto: str,
+    saida: csv.DictWriter,
+):
+    caminho = pasta / arquivo
+    try:
+        numero_questao = Path(arquivo).stem
+        classificacoes, materia, gabarito = await classificar_questao(
+            numero_questao, texto, ano, semestre
+        )
+
+        saida.writerows(
+            montar_linhas(
+                arquivo,
+                caminho,
+                texto,
+                classificacoes,
+                ano,
+                semestre,
+                materia,
+                gabarito,
+            )
+        )
+        logging.info(
+            f"Q{numero_questao} ({ano}/{semestre}) salva em {ARQUIVO_SAIDA_CSV}"
+        )
+
+    except Exception as e:
+        logging.error(f"Erro ao processar {arquivo}: {e}")
+
+
+async def processar_lote_imagens(
+    arquivos: List[str],
+    infos: Dict[str, Tuple[str, str]],
+    chave: str,
+    pasta: Path,
+    ano: int,
+    semestre: int,
+    saida: csv.DictWriter,
+):
+    numeros = [Path(a).stem for a in arquivos]
+    try:
+        por_numero = await classificar_lote_imagens(
+            numeros, [pasta / a for a in arquivos], chave, ano, semestre
+        )
+    except Exception as e:
+        logging.error(f"Erro ao classificar lote {numeros}: {e}")
+        for arquivo, numero in zip(arquivos, numeros):
+            erro = [{"numero_questao": numero, "tema": "ERRO", "topico": f"Erro: {e}"}]
+            saida.writerows(
+                montar_linhas(
+                    arquivo, pasta / arquivo, "", erro, ano, semestre, "ERRO", "ERRO"
+                )
+            )
+        return
+
+    for arquivo, numero in zip(arquivos, numeros):
+        classificacoes = por_numero.get(normalizar_numero(numero), [])
+        if not classificacoes:
+            logging.warning(f"Q{numero} ({ano}/{semestre}) sem classificação no lote")
+            continue
+        materia, gabarito = infos[arquivo]
+        for c in classificacoes:
+            c["numero_questao"] = numero
+        saida.writerows(
+            montar_linhas(
+                arquivo,
+                pasta / arquivo,
+                "",
+                classificacoes,
+                ano,
+                semestre,
+                materia,
+                gabarito,
+            )
+        )
+        logging.info(f"Q{numero} ({ano}/{semestre}) salva em {ARQUIVO_SAIDA_CSV}")
+
+
+_lock_vagas = asyncio.Lock()
+
+
+async def reservar_vagas(vagas: asyncio.Semaphore, n: int):
+    """
+    Ocupa n vagas de uma vez. O lock impede que dois produtores fiquem cada
+    um com parte das vagas esperando pelo resto.
+    """
+    async with _lock_vagas:
+        for _ in range(n):
+            await vagas.acquire()
+
+
+async def enfileirar_lotes_imagens(
+    arquivos: List[str],
+    pasta: Path,
+    ano: int,
+    semestre: int,
+    fila: asyncio.Queue,
+    vagas: asyncio.Semaphore,
+):
+    """Agrupa as questões por lista de assuntos e enfileira lotes de imagens."""
+    infos = {
+        arquivo: obter_info_questao(Path(arquivo).stem, ano, semestre)
+        for arquivo in arquivos
+    }
+    por_chave: Dict[str, List[str]] = {}
+    for arquivo in arquivos:
+        por_chave.setdefault(chave_assuntos(infos[arquivo][0]), []).append(arquivo)
+
+    for chave, grupo in por_chave.items():
+        for i in range(0, len(grupo), TAMANHO_LOTE_IMAGENS):
+            lote = grupo[i : i + TAMANHO_LOTE_IMAGENS]
+            await vagas.acquire()
+            await fila.put(
+                functools.partial(
+                    processar_lote_imagens, lote, infos, chave, pasta, ano, semestre
+                )
+            )
+
+
+async def processar_ano_semestre(
+    ano: int,
+    semestre: int,
+    ocr_pool: ProcessPoolExecutor,
+    fila: asyncio.Queue,
+    vagas: asyncio.Semaphore,
+    processados: Set[Tuple[str, int, int]],
+):
+    """
+    Produtor: faz o OCR da pasta e enfileira os textos à medida que ficam
+    prontos (ou, com CLASSIFICAR_IMAGENS, enfileira lotes de imagens).
+    """
     pasta = construir_caminho_pasta(ano, semestre)
     if not pasta.exists():
         logging.warning(f"Pasta não encontrada: {pasta}")
         return
 
     arquivos = listar_arquivos_para_processar(pasta, ano, semestre, SELECOES)
+    pendentes = [a for a in arquivos if (a, ano, semestre) not in processados]
+    if len(pendentes) < len(arquivos):
+        logging.info(
+            f"Pulando {len(arquivos) - len(pendentes)} arquivo(s) de {ano}/{semestre} já processado(s)"
+        )
+    arquivos = pendentes
     logging.info(f"Processando {ano}/{semestre} - {len(arquivos)} arquivo(s)")
 
-    for arquivo in arquivos:
-        caminho = pasta / arquivo
+    if not arquivos:
+        return
+
+    if CLASSIFICAR_IMAGENS:
+        await enfileirar_lotes_imagens(arquivos, pasta, ano, semestre, fila, vagas)
+        return
+
+    async def ocr_e_enfileirar(arquivo: str, ocr: Awaitable[str]):
         try:
-            numero_questao = Path(arquivo).stem
-            imagem = Image.open(caminho)
-            texto = pytesseract.image_to_string(imagem, lang="por")
+            texto = await ocr
+        except Exception as e:
+            logging.error(f"Erro ao processar {arquivo}: {e}")
+            vagas.release()
+            return
+        await fila.put(
+            functools.partial(processar_arquivo, arquivo, pasta, ano, semestre, texto)
+        )
 
-            classificacoes, materia, gabarito = classificar_questao(
-                numero_questao, texto, ano, semestre
-            )
+    # Cada arquivo ocupa uma vaga antes de ir para o OCR; as vagas (LIMITE_OCR,
+    # comuns a todos os produtores) só voltam quando um consumidor tira o item
+    # da fila. Com os consumidores atrasados, o OCR para de ser disparado.
+    tamanho_lote = 1 if USA_TESSEROCR else OCR_IMAGENS_POR_EXECUCAO
+    tarefas = []
+    for i in range(0, len(arquivos), tamanho_lote):
+        lote = arquivos[i : i + tamanho_lote]
+        await reservar_vagas(vagas, len(lote))
+        ocrs = agendar_ocr([pasta / arquivo for arquivo in lote], ocr_pool)
+        tarefas.extend(
+            asyncio.create_task(ocr_e_enfileirar(arquivo, ocr))
+            for arquivo, ocr in zip(lote, ocrs)
+        )
+    await asyncio.gather(*tarefas)
+
+
+async def consumir_fila(
+    fila: asyncio.Queue, vagas: asyncio.Semaphore, saida: csv.DictWriter
+):
+    """Consumidor: classifica no Gemini e grava cada item que sai da fila."""
+    while True:
+        item = await fila.get()
+        vagas.release()
+        try:
+            await item(saida)
+        finally:
+            fila.task_done()
 
-            linhas = []
-            for c in classificacoes:
-                linhas.append(
-                    {
-                        "arquivo": arquivo,
-                        "caminho_completo": str(caminho),
-                        "numero_questao": c["numero_questao"],
-                        "texto_questao": texto,
-                        "tema": c["tema"],
-                        "topico": c["topico"],
-                        "ano": ano,
-                        "semestre": semestre,
-                        "materia": materia,
-                        "gabarito": gabarito,
-                    }
+
+# ── Saída ──────────────────────────────────────────────────────────────────
+def abrir_saida_csv():
+    """
+    Abre ARQUIVO_SAIDA_CSV para append. Na primeira execução com um
+    ARQUIVO_SAIDA antigo, ele é usado como ponto de partida do CSV.
+    """
+    if not ARQUIVO_SAIDA_CSV.exists() and ARQUIVO_SAIDA.exists():
+        pd.read_excel(ARQUIVO_SAIDA).to_csv(
+            ARQUIVO_SAIDA_CSV, index=False, encoding="utf-8"
+        )
+        logging.info(f"{ARQUIVO_SAIDA} copiado para {ARQUIVO_SAIDA_CSV}")
+
+    novo = not ARQUIVO_SAIDA_CSV.exists()
+    f = open(ARQUIVO_SAIDA_CSV, "a", newline="", encoding="utf-8", buffering=1)
+    writer = csv.DictWriter(f, fieldnames=COLUNAS_SAIDA)
+    if novo:
+        writer.writeheader()
+    return f, writer
+
+
+def carregar_processados() -> Set[Tuple[str, int, int]]:
+    """
+    Chaves (arquivo, ano, semestre) já presentes em ARQUIVO_SAIDA_CSV, para
+    retomar uma execução interrompida. Questões que terminaram em ERRO não
+    entram, e são processadas de novo.
+    """
+    processados: Set[Tuple[str, int, int]] = set()
+    if not ARQUIVO_SAIDA_CSV.exists():
+        return processados
+    with open(ARQUIVO_SAIDA_CSV, newline="", encoding="utf-8") as f:
+        for linha in csv.DictReader(f):
+            if linha.get("tema") == "ERRO":
+                continue
+            try:
+                processados.add(
+                    (linha["arquivo"], int(linha["ano"]), int(linha["semestre"]))
                 )
+            except (KeyError, TypeError, ValueError):
+                continue
+    logging.info(
+        f"{len(processados)} arquivo(s) já processado(s) em {ARQUIVO_SAIDA_CSV}"
+    )
+    return processados
 
-            nova_linha = pd.DataFrame(linhas)
 
-            if ARQUIVO_SAIDA.exists():
-                df_existente = pd.read_excel(ARQUIVO_SAIDA)
-                df_completo = pd.concat([df_existente, nova_linha], ignore_index=True)
-            else:
-                df_completo = nova_linha
+# Colunas numéricas na planilha final (no CSV tudo é texto)
+COLUNAS_INTEIRAS = {"numero_questao", "ano", "semestre"}
 
-            df_completo.to_excel(ARQUIVO_SAIDA, index=False)
-            logging.info(
-                f"Q{numero_questao} ({ano}/{semestre}) salva em {ARQUIVO_SAIDA}"
-            )
 
-        except Exception as e:
-            logging.error(f"Erro ao processar {arquivo}: {e}")
+def _valor_celula(coluna: str, valor: str):
+    if coluna in COLUNAS_INTEIRAS and valor.isdigit():
+        return int(valor)
+    return ILLEGAL_CHARACTERS_RE.sub("", valor)
+
+
+def _chave_linha(linha: Dict[str, str]) -> Tuple[str, str, str]:
+    return (linha.get("arquivo"), linha.get("ano"), linha.get("semestre"))
+
+
+def exportar_saida_excel():
+    """
+    Converte o CSV para ARQUIVO_SAIDA linha a linha, sem montar um DataFrame.
+    Linhas ERRO de arquivos que depois foram classificados numa nova execução
+    ficam de fora.
+    """
+    with open(ARQUIVO_SAIDA_CSV, newline="", encoding="utf-8") as f:
+        classificados = {
+            _chave_linha(linha)
+            for linha in csv.DictReader(f)
+            if linha.get("tema") != "ERRO"
+        }
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+    with open(ARQUIVO_SAIDA_CSV, newline="", encoding="utf-8") as f:
+        leitor = csv.DictReader(f)
+        cabecalho = leitor.fieldnames or COLUNAS_SAIDA
+        ws.append(cabecalho)
+        for linha in leitor:
+            if linha.get("tema") == "ERRO" and _chave_linha(linha) in classificados:
+                continue
+            ws.append([_valor_celula(c, linha.get(c) or "") for c in cabecalho])
+    wb.save(ARQUIVO_SAIDA)
+    logging.info(f"Resultados exportados para {ARQUIVO_SAIDA}")
+
+
+# ── Inicialização ────────────────────────────────────────────────────────────
+# Carregado só no processo principal, em inicializar(): os workers de OCR
+# importam este módulo e não precisam de planilhas, cliente ou caches.
+client: Optional[genai.Client] = None
+CACHE_RESPOSTAS: Optional[Cache] = None
+BD: Dict[Tuple[int, int, int], Tuple[str, str]] = {}
+ASSUNTOS_CSV: Dict[str, str] = {}
+SELECOES: Dict[Tuple[int, int], Set[str]] = {}
+
+
+def inicializar():
+    global client, CACHE_RESPOSTAS, BD, ASSUNTOS_CSV, SELECOES
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[logging.FileHandler("processamento.log"), logging.StreamHandler()],
+    )
+    logging.info("Iniciando script de classificação de questões")
+
+    client = genai.Client(api_key=os.getenv("GENAI_API_KEY"))
+    CACHE_RESPOSTAS = Cache(CACHE_RESPOSTAS_DIR)
+
+    try:
+        tabela_assuntos = carregar_tabela(ARQUIVO_LISTA_ASSUNTOS)
+        logging.info(f"Lista de assuntos carregada ({len(tabela_assuntos)} tópicos)")
+    except Exception as e:
+        logging.error(f"Erro ao carregar {ARQUIVO_LISTA_ASSUNTOS}: {e}")
+        raise
+
+    try:
+        bd_questoes = carregar_tabela(ARQUIVO_BD_QUESTOES)
+        logging.info(f"BD de questões carregado ({len(bd_questoes)} registros)")
+    except Exception as e:
+        logging.error(f"Erro ao carregar {ARQUIVO_BD_QUESTOES}: {e}")
+        raise
+
+    BD = indexar_bd(bd_questoes)
+    ASSUNTOS_CSV = montar_assuntos_csv(tabela_assuntos)
+    SELECOES = carregar_selecoes()
 
 
 # ── Loop principal ────────────────────────────────────────────────────────────
-for cfg in ANOS_SEMESTRES:
-    processar_ano_semestre(int(cfg["ano"]), int(cfg["semestre"]))
+async def main():
+    inicializar()
+    # OCR (CPU) e Gemini (rede) em pipeline: as vagas seguram o OCR de todos
+    # os produtores quando os consumidores ficam para trás
+    fila: asyncio.Queue = asyncio.Queue(maxsize=TAMANHO_FILA)
+    vagas = asyncio.Semaphore(LIMITE_OCR)
+    arquivo_csv, saida = abrir_saida_csv()
+    processados = carregar_processados()
+    consumidores = [
+        asyncio.create_task(consumir_fila(fila, vagas, saida))
+        for _ in range(MAX_CONCORRENCIA)
+    ]
+    try:
+        with ProcessPoolExecutor(
+            max_workers=os.cpu_count(), initializer=inicializar_worker_ocr
+        ) as ocr_pool:
+            await asyncio.gather(
+                *(
+                    processar_ano_semestre(
+                        int(cfg["ano"]),
+                        int(cfg["semestre"]),
+                        ocr_pool,
+                        fila,
+                        vagas,
+                        processados,
+                    )
+                    for cfg in ANOS_SEMESTRES
+                )
+            )
+        await fila.join()
+    finally:
+        for consumidor in consumidores:
+            consumidor.cancel()
+        await asyncio.gather(*consumidores, return_exceptions=True)
+        arquivo_csv.close()
+        await remover_caches()
+    exportar_saida_excel()
+    logging.info("Processamento concluído")
+
 
-logging.info("Processamento concluído")
+if __name__ == "__main__":
+    asyncio.run(main())
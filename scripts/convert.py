@@ -0,0 +1,22 @@
+"""
+Converte as planilhas de entrada para Parquet, lido pelo main.py no lugar do
+Excel. Rodar de novo sempre que bd_questoes.xlsx ou lista_assuntos.xlsx mudarem.
+"""
+
+from pathlib import Path
+
+import pandas as pd
+
+RAIZ = Path(__file__).resolve().parent.parent
+PLANILHAS = [RAIZ / "bd_questoes.xlsx", RAIZ / "lista_assuntos.xlsx"]
+
+
+def main():
+    for planilha in PLANILHAS:
+        destino = planilha.with_suffix(".parquet")
+        pd.read_excel(planilha).to_parquet(destino, index=False)
+        print(f"{planilha.name} -> {destino.name}")
+
+
+if __name__ == "__main__":
+    main()